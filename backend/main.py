@@ -1,15 +1,62 @@
-from fastapi import FastAPI, UploadFile, File, HTTPException
+from fastapi import FastAPI, UploadFile, File, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from contextlib import asynccontextmanager
 from pathlib import Path
-import uuid
-import json
+from typing import List
+import aiofiles
+import aiofiles.os
+import asyncio
+import blake3
+import orjson
+import os
+import secrets
 from datetime import datetime
-from .models import FieldDocument
-from .vision import extract_document_data
+from pydantic import ValidationError
+from .models import ArrivalDeparture, FieldDocument
+from .store import ResultStore
+from .vision import EXTRACTION_VERSION, extract_document_data, shutdown_cpu_pool
 
-app = FastAPI(title="Maritime Document Extractor")
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    shutdown_cpu_pool()
+
+
+app = FastAPI(title="Maritime Document Extractor", lifespan=lifespan)
+
+UPLOAD_DIR = Path(os.getenv("UPLOAD_DIR", "/app/uploads"))
+UPLOAD_DIR.mkdir(exist_ok=True)
+
+CHUNK_SIZE = 1 << 20
+MAX_UPLOAD_BYTES = 25 * 1024 * 1024
+MAX_BATCH_FILES = 10
+MULTIPART_OVERHEAD = 64 * 1024
+
+
+def _max_request_bytes(path: str) -> int | None:
+    if path == "/api/upload_batch":
+        return MAX_BATCH_FILES * MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+    if path in ("/api/upload", "/api/upload_stream"):
+        return MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD
+    return None
+
+
+# Starlette spools the whole multipart body before a handler runs, so the checks in
+# save_upload only save disk writes and LLM calls; this is the one place to refuse
+# a declared-oversize upload before its bytes arrive.
+@app.middleware("http")
+async def limit_upload_size(request: Request, call_next):
+    """Reject uploads whose Content-Length exceeds the route's limit."""
+    limit = _max_request_bytes(request.url.path)
+    length = request.headers.get("content-length", "")
+    if limit is not None and length.isdigit() and int(length) > limit:
+        return JSONResponse({"detail": "File too large"}, status_code=413)
+    return await call_next(request)
+
+
+# added after the size limit so its 413s still carry CORS headers
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -17,48 +64,245 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-UPLOAD_DIR = Path("/app/uploads")
-UPLOAD_DIR.mkdir(exist_ok=True)
+HEALTH_BYTES = b'{"status":"healthy"}'
+
+results = ResultStore(UPLOAD_DIR / "results.db")
+extractions = ResultStore(UPLOAD_DIR / "results.db", table="extractions")
+_background: set[asyncio.Task] = set()
+_inflight: dict[str, asyncio.Future] = {}
+
+
+def _is_image(head: bytes) -> bool:
+    """Check the leading bytes for a JPEG, PNG or WebP signature."""
+    return (
+        head.startswith(b"\xff\xd8\xff")
+        or head.startswith(b"\x89PNG\r\n\x1a\n")
+        or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")
+    )
+
+
+async def save_upload(file: UploadFile, path: Path) -> str:
+    """Check magic bytes, stream the upload to disk with a size cap and return its BLAKE3 digest."""
+    head = await file.read(12)
+    if not _is_image(head):
+        raise HTTPException(400, "Only JPEG, PNG or WebP images are accepted")
+
+    size = len(head)
+    hasher = blake3.blake3(head)
+    tmp = path.with_name(path.name + ".part")
+    try:
+        async with aiofiles.open(tmp, "wb") as out:
+            await out.write(head)
+            while chunk := await file.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_UPLOAD_BYTES:
+                    raise HTTPException(413, "File too large")
+                hasher.update(chunk)
+                await out.write(chunk)
+        # publish only complete files; os.replace is atomic on POSIX
+        await aiofiles.os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+    return hasher.hexdigest()
+
+
+def _validate_cached(data: dict | None) -> FieldDocument | None:
+    """Return a cached extraction as a FieldDocument, or None if absent or stale."""
+    if data is None:
+        return None
+    try:
+        return FieldDocument.model_validate(data)
+    except ValidationError:
+        return None
+
+
+async def extract_cached(path: Path, digest: str, on_delta=None) -> FieldDocument:
+    """Extract a document, reusing or sharing any extraction of identical image bytes."""
+    key = f"{EXTRACTION_VERSION}:{digest}"
+    data = await extractions.get(key)
+    while True:
+        # the owner may have stored its result while our database read was in flight;
+        # a record that no longer validates counts as a miss and is overwritten below
+        if (doc := _validate_cached(data) or _validate_cached(extractions.peek(key))) is not None:
+            return doc
+        shared = _inflight.get(key)
+        if shared is None:
+            break
+        try:
+            return await asyncio.shield(shared)
+        except asyncio.CancelledError:
+            # the owning request was cancelled; take over the extraction
+            if not shared.cancelled():
+                raise
+        data = None
+
+    future = asyncio.get_running_loop().create_future()
+    _inflight[key] = future
+    try:
+        doc = await extract_document_data(path, on_delta=on_delta)
+    except asyncio.CancelledError:
+        future.cancel()
+        raise
+    except Exception as e:
+        future.set_exception(e)
+        future.exception()  # mark retrieved so lone failures aren't logged twice
+        raise
+    else:
+        future.set_result(doc)
+        await extractions.put(key, doc.model_dump(mode="json"))
+        return doc
+    finally:
+        _inflight.pop(key, None)
+
+
+async def store_result(file_id: str, data: dict, **meta) -> dict:
+    """Persist a completed extraction and return the API response body."""
+    await results.put(
+        file_id,
+        {"id": file_id, **meta, "processed_at": datetime.utcnow().isoformat(), "data": data},
+    )
+    return {"id": file_id, "status": "completed", "data": data}
+
+
+def _sse(event: str, payload: dict) -> bytes:
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(payload) + b"\n\n"
 
 
 @app.post("/api/upload")
-async def upload_document(file: UploadFile = File(...)):
+async def upload_document(file: UploadFile = File(...)) -> dict:
     if not file.content_type.startswith("image/"):
         raise HTTPException(400, "Only image files are accepted")
 
-    file_id = str(uuid.uuid4())
+    file_id = secrets.token_urlsafe(12)
     ext = Path(file.filename).suffix
     path = UPLOAD_DIR / f"{file_id}{ext}"
-    content = await file.read()
-    path.write_bytes(content)
+    digest = await save_upload(file, path)
 
     try:
-        doc: FieldDocument = await run_in_threadpool(extract_document_data, path)
-        result = {"id": file_id, "status": "completed", "data": doc.model_dump()}
-        (UPLOAD_DIR / f"{file_id}_result.json").write_text(
-            json.dumps(
-                {
-                    "id": file_id,
-                    "filename": file.filename,
-                    "processed_at": datetime.utcnow().isoformat(),
-                    "data": doc.model_dump(),
-                },
-                indent=2,
-            )
-        )
-        return result
+        doc: FieldDocument = await extract_cached(path, digest)
+        return await store_result(file_id, doc.model_dump(mode="json"), filename=file.filename)
     except Exception as e:
         return {"id": file_id, "status": "error", "error": str(e)}
 
 
+def _merge_leg(base: ArrivalDeparture, page: ArrivalDeparture) -> None:
+    base.tanks.extend(page.tanks)
+    for field in ("water_specific_gravity", "drafts_ft", "timestamps"):
+        if getattr(base, field) is None:
+            setattr(base, field, getattr(page, field))
+    if page.summary_by_product:
+        base.summary_by_product = {**page.summary_by_product, **(base.summary_by_product or {})}
+
+
+def merge_documents(docs: List[FieldDocument]) -> FieldDocument:
+    """Merge per-page extractions into one document; earlier pages win on conflicts."""
+    merged = docs[0].model_copy(deep=True)
+    for page in docs[1:]:
+        _merge_leg(merged.arrival, page.arrival)
+        _merge_leg(merged.departure, page.departure)
+        if page.products_loaded_discharged:
+            merged.products_loaded_discharged = {
+                **page.products_loaded_discharged,
+                **(merged.products_loaded_discharged or {}),
+            }
+    return merged
+
+
+@app.post("/api/upload_batch")
+async def upload_batch(files: List[UploadFile] = File(...)) -> dict:
+    if len(files) > MAX_BATCH_FILES:
+        raise HTTPException(400, f"At most {MAX_BATCH_FILES} files per batch")
+    if not all(f.content_type.startswith("image/") for f in files):
+        raise HTTPException(400, "Only image files are accepted")
+
+    file_id = secrets.token_urlsafe(12)
+    paths = [UPLOAD_DIR / f"{file_id}_{i}{Path(f.filename).suffix}" for i, f in enumerate(files)]
+    saved = await asyncio.gather(*(save_upload(f, p) for f, p in zip(files, paths)), return_exceptions=True)
+    failure = next((r for r in saved if isinstance(r, BaseException)), None)
+    if failure is not None:
+        # reject the whole batch; don't leave the pages that did save behind
+        for path in paths:
+            path.unlink(missing_ok=True)
+        raise failure
+    digests = saved
+
+    pages = await asyncio.gather(
+        *(extract_cached(p, d) for p, d in zip(paths, digests)), return_exceptions=True
+    )
+    docs = [page for page in pages if isinstance(page, FieldDocument)]
+    errors = [f"{f.filename}: {page}" for f, page in zip(files, pages) if isinstance(page, BaseException)]
+    if not docs:
+        return {"id": file_id, "status": "error", "error": "; ".join(errors)}
+
+    meta = {"filenames": [f.filename for f in files]}
+    if errors:
+        meta["errors"] = errors
+    result = await store_result(file_id, merge_documents(docs).model_dump(mode="json"), **meta)
+    if errors:
+        result["errors"] = errors
+    return result
+
+
+@app.post("/api/upload_stream")
+async def upload_document_stream(file: UploadFile = File(...)):
+    """Like /api/upload, but streams model output as server-sent events.
+
+    Emits ``delta`` events carrying ``{"attempt", "text"}`` while the model is
+    generating, then a single ``result`` event with the /api/upload response body.
+    """
+    if not file.content_type.startswith("image/"):
+        raise HTTPException(400, "Only image files are accepted")
+
+    file_id = secrets.token_urlsafe(12)
+    path = UPLOAD_DIR / f"{file_id}{Path(file.filename).suffix}"
+    digest = await save_upload(file, path)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_delta(attempt: int, text: str) -> None:
+        await queue.put(_sse("delta", {"attempt": attempt, "text": text}))
+
+    async def run() -> None:
+        try:
+            doc = await extract_cached(path, digest, on_delta)
+            result = await store_result(file_id, doc.model_dump(mode="json"), filename=file.filename)
+        except Exception as e:
+            result = {"id": file_id, "status": "error", "error": str(e)}
+        await queue.put(_sse("result", result))
+        await queue.put(None)
+
+    # keep extracting even if the client disconnects so /api/result still resolves
+    task = asyncio.create_task(run())
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+    async def events():
+        while (event := await queue.get()) is not None:
+            yield event
+
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+
+async def _read_legacy_result(file_id: str) -> dict | None:
+    """Read a result written as ``<id>_result.json`` before results moved to SQLite."""
+    legacy_path = UPLOAD_DIR / f"{file_id}_result.json"
+    try:
+        async with aiofiles.open(legacy_path, "rb") as f:
+            return orjson.loads(await f.read())
+    except FileNotFoundError:
+        return None
+
+
 @app.get("/api/result/{file_id}")
-async def get_result(file_id: str):
-    result_path = UPLOAD_DIR / f"{file_id}_result.json"
-    if not result_path.exists():
+async def get_result(file_id: str) -> dict:
+    record = await results.get(file_id)
+    if record is None:
+        record = await _read_legacy_result(file_id)
+    if record is None:
         raise HTTPException(404, "Result not found")
-    return json.loads(result_path.read_text())
+    return record
 
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return Response(HEALTH_BYTES, media_type="application/json")
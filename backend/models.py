@@ -1,4 +1,4 @@
-from pydantic import BaseModel, Field, ConfigDict
+from pydantic import BaseModel, Field, ConfigDict, TypeAdapter
 from typing import Dict, List, Optional
 from datetime import datetime
 
@@ -74,3 +74,6 @@ class FieldDocument(BaseModel):
     products_loaded_discharged: Optional[Dict[str, ProductTotals]] = None
 
     model_config = ConfigDict(extra='forbid')
+
+FieldDocument.model_rebuild()
+FIELD_DOC_ADAPTER = TypeAdapter(FieldDocument)
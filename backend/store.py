@@ -0,0 +1,51 @@
+import asyncio
+import sqlite3
+import threading
+from pathlib import Path
+
+import orjson
+from cachetools import TTLCache
+
+
+class ResultStore:
+    """In-memory TTL cache of JSON records backed by a table in a SQLite WAL database."""
+
+    def __init__(self, db_path: Path, table: str = "results", maxsize: int = 1024, ttl: float = 3600):
+        self._table = table
+        self._cache: TTLCache = TTLCache(maxsize=maxsize, ttl=ttl)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table} (id TEXT PRIMARY KEY, json BLOB NOT NULL)")
+        self._conn.commit()
+
+    async def put(self, result_id: str, record: dict) -> None:
+        """Persist a record, then cache it; returns once the row is committed."""
+        await asyncio.to_thread(self._write, result_id, orjson.dumps(record))
+        self._cache[result_id] = record
+
+    def peek(self, result_id: str) -> dict | None:
+        """Return a cached record without touching the database."""
+        return self._cache.get(result_id)
+
+    async def get(self, result_id: str) -> dict | None:
+        record = self._cache.get(result_id)
+        if record is not None:
+            return record
+        row = await asyncio.to_thread(self._read, result_id)
+        if row is None:
+            return None
+        record = orjson.loads(row)
+        self._cache[result_id] = record
+        return record
+
+    def _write(self, result_id: str, payload: bytes) -> None:
+        with self._lock:
+            self._conn.execute(f"INSERT OR REPLACE INTO {self._table} (id, json) VALUES (?, ?)", (result_id, payload))
+            self._conn.commit()
+
+    def _read(self, result_id: str) -> bytes | None:
+        with self._lock:
+            row = self._conn.execute(f"SELECT json FROM {self._table} WHERE id = ?", (result_id,)).fetchone()
+        return row[0] if row else None
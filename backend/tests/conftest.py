@@ -0,0 +1,8 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# main.py creates its upload dir and SQLite store at import time
+os.environ.setdefault("UPLOAD_DIR", tempfile.mkdtemp(prefix="sfk2-uploads-"))
+sys.path.insert(0, str(Path(__file__).resolve().parents[2]))
@@ -0,0 +1,191 @@
+import asyncio
+from io import BytesIO
+
+import pytest
+from fastapi import HTTPException, UploadFile
+from fastapi.testclient import TestClient
+
+from backend import main
+from backend.models import FieldDocument
+
+JPEG_HEAD = b"\xff\xd8\xff\xe0" + b"\x00" * 8
+
+
+def make_doc(tanks, summary=None) -> FieldDocument:
+    leg = {"tanks": [dict(tank_id=t, product="ULSD", api=35.0, ullage_ft=1, ullage_in=2,
+                          temperature_f=60, gross_bbls=100) for t in tanks],
+           "summary_by_product": summary}
+    return FieldDocument.model_validate(
+        {"barge": {"name": "B"}, "port": {"vessel_name": "V"}, "arrival": leg, "departure": leg}
+    )
+
+
+def upload(data: bytes, name: str = "page.jpg") -> UploadFile:
+    return UploadFile(file=BytesIO(data), filename=name)
+
+
+def test_merge_documents_appends_tanks_and_keeps_first_summary():
+    first = make_doc(["1P"], {"ULSD": {"gross_bbls": 1.0}})
+    second = make_doc(["2P"], {"ULSD": {"gross_bbls": 2.0}, "RBOB": {"gross_bbls": 3.0}})
+
+    merged = main.merge_documents([first, second])
+
+    assert [t.tank_id for t in merged.arrival.tanks] == ["1P", "2P"]
+    assert merged.arrival.summary_by_product["ULSD"].gross_bbls == 1.0
+    assert merged.arrival.summary_by_product["RBOB"].gross_bbls == 3.0
+    assert [t.tank_id for t in first.arrival.tanks] == ["1P"]
+
+
+@pytest.mark.parametrize(
+    "head, expected",
+    [
+        (JPEG_HEAD, True),
+        (b"\x89PNG\r\n\x1a\n\x00\x00\x00\x00", True),
+        (b"RIFF\x00\x00\x00\x00WEBP", True),
+        (b"%PDF-1.7\n\x00\x00\x00", False),
+    ],
+)
+def test_is_image(head, expected):
+    assert main._is_image(head) is expected
+
+
+def test_save_upload_rejects_non_images_without_writing(tmp_path):
+    path = tmp_path / "x.jpg"
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.save_upload(upload(b"not an image at all"), path))
+    assert exc.value.status_code == 400
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_save_upload_rejects_oversize_and_cleans_up(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 16)
+    path = tmp_path / "x.jpg"
+    with pytest.raises(HTTPException) as exc:
+        asyncio.run(main.save_upload(upload(JPEG_HEAD + b"\x00" * 32), path))
+    assert exc.value.status_code == 413
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_extract_cached_coalesces_concurrent_duplicates(monkeypatch):
+    calls = []
+
+    async def fake_extract(path, on_delta=None):
+        calls.append(path)
+        await asyncio.sleep(0.05)
+        return make_doc(["1P"])
+
+    monkeypatch.setattr(main, "extract_document_data", fake_extract)
+
+    async def run():
+        return await asyncio.gather(*(main.extract_cached(main.UPLOAD_DIR / "p.jpg", "coalesce") for _ in range(3)))
+
+    docs = asyncio.run(run())
+    assert len(calls) == 1
+    assert all(doc.arrival.tanks[0].tank_id == "1P" for doc in docs)
+
+
+def test_extract_cached_hit_skips_extraction(monkeypatch):
+    async def fail_extract(path, on_delta=None):
+        raise AssertionError("cache hit must not call the model")
+
+    monkeypatch.setattr(main, "extract_document_data", fail_extract)
+    key = f"{main.EXTRACTION_VERSION}:cached"
+    asyncio.run(main.extractions.put(key, make_doc(["9S"]).model_dump(mode="json")))
+
+    doc = asyncio.run(main.extract_cached(main.UPLOAD_DIR / "p.jpg", "cached"))
+    assert doc.arrival.tanks[0].tank_id == "9S"
+
+
+def test_extract_cached_reextracts_and_overwrites_stale_record(monkeypatch):
+    calls = []
+
+    async def fake_extract(path, on_delta=None):
+        calls.append(path)
+        return make_doc(["1P"])
+
+    monkeypatch.setattr(main, "extract_document_data", fake_extract)
+    key = f"{main.EXTRACTION_VERSION}:stale"
+    asyncio.run(main.extractions.put(key, {"barge": {"old_field": 1}}))
+
+    doc = asyncio.run(main.extract_cached(main.UPLOAD_DIR / "p.jpg", "stale"))
+    assert doc.arrival.tanks[0].tank_id == "1P"
+    assert len(calls) == 1
+    assert asyncio.run(main.extractions.get(key))["arrival"]["tanks"][0]["tank_id"] == "1P"
+
+
+def test_extract_cached_waiter_takes_over_when_owner_is_cancelled(monkeypatch):
+    calls = []
+
+    async def fake_extract(path, on_delta=None):
+        calls.append(path)
+        await asyncio.sleep(0.05)
+        return make_doc(["1P"])
+
+    monkeypatch.setattr(main, "extract_document_data", fake_extract)
+
+    async def run():
+        owner = asyncio.create_task(main.extract_cached(main.UPLOAD_DIR / "p.jpg", "takeover"))
+        await asyncio.sleep(0.01)
+        waiter = asyncio.create_task(main.extract_cached(main.UPLOAD_DIR / "p.jpg", "takeover"))
+        await asyncio.sleep(0.01)
+        owner.cancel()
+        return await waiter
+
+    assert asyncio.run(run()).arrival.tanks[0].tank_id == "1P"
+    assert len(calls) == 2
+
+
+def test_upload_batch_limits_file_count(monkeypatch):
+    monkeypatch.setattr(main, "MAX_BATCH_FILES", 2)
+    files = [("files", (f"{i}.jpg", JPEG_HEAD, "image/jpeg")) for i in range(3)]
+    response = TestClient(main.app).post("/api/upload_batch", files=files)
+    assert response.status_code == 400
+
+
+def test_upload_batch_rejects_bad_page_without_orphans():
+    before = set(main.UPLOAD_DIR.iterdir())
+    files = [
+        ("files", ("good.jpg", JPEG_HEAD + b"\x00" * 64, "image/jpeg")),
+        ("files", ("bad.jpg", b"plain text, not a jpeg", "image/jpeg")),
+    ]
+    response = TestClient(main.app).post("/api/upload_batch", files=files)
+    assert response.status_code == 400
+    assert set(main.UPLOAD_DIR.iterdir()) == before
+
+
+def test_oversize_content_length_is_rejected_before_the_handler(monkeypatch):
+    monkeypatch.setattr(main, "MAX_UPLOAD_BYTES", 16)
+    monkeypatch.setattr(main, "MULTIPART_OVERHEAD", 0)
+    monkeypatch.setattr(main, "save_upload", None)  # the handler must not run
+    files = {"file": ("page.jpg", JPEG_HEAD + b"\x00" * 64, "image/jpeg")}
+    response = TestClient(main.app).post("/api/upload", files=files, headers={"Origin": "http://example.com"})
+    assert response.status_code == 413
+    assert response.headers["access-control-allow-origin"] == "*"
+
+
+def test_get_result_falls_back_to_legacy_result_file():
+    (main.UPLOAD_DIR / "legacy-id_result.json").write_bytes(b'{"id": "legacy-id", "data": {}}')
+    client = TestClient(main.app)
+    assert client.get("/api/result/legacy-id").json() == {"id": "legacy-id", "data": {}}
+    assert client.get("/api/result/missing-id").status_code == 404
+
+
+def test_upload_batch_records_page_errors_in_stored_result(monkeypatch):
+    async def fake_extract(path, on_delta=None):
+        if path.name.endswith("_1.jpg"):
+            raise ValueError("unreadable page")
+        return make_doc(["1P"])
+
+    monkeypatch.setattr(main, "extract_document_data", fake_extract)
+    files = [
+        ("files", ("good.jpg", JPEG_HEAD + b"good page", "image/jpeg")),
+        ("files", ("bad.jpg", JPEG_HEAD + b"bad page", "image/jpeg")),
+    ]
+    client = TestClient(main.app)
+    response = client.post("/api/upload_batch", files=files).json()
+
+    assert response["status"] == "completed"
+    assert response["errors"] == ["bad.jpg: unreadable page"]
+    stored = client.get(f"/api/result/{response['id']}").json()
+    assert stored["errors"] == response["errors"]
+    assert stored["data"] == response["data"]
@@ -0,0 +1,101 @@
+import asyncio
+import concurrent.futures
+import os
+import signal
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+from pydantic import ValidationError
+
+from backend import vision
+
+
+def test_prepare_image_downscales_to_grayscale_jpeg(tmp_path):
+    path = tmp_path / "scan.jpg"
+    Image.new("RGB", (4000, 3000), "white").save(path, quality=90)
+
+    out = tmp_path / "out.jpg"
+    out.write_bytes(vision.prepare_image(path))
+
+    with Image.open(out) as img:
+        assert img.format == "JPEG"
+        assert img.mode == "L"
+        assert max(img.size) == vision.MAX_IMAGE_SIDE
+
+
+def test_run_in_cpu_pool_replaces_a_broken_pool_once(monkeypatch):
+    created = []
+
+    class CountingPool(concurrent.futures.ProcessPoolExecutor):
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            created.append(self)
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", CountingPool)
+    monkeypatch.setattr(vision, "_cpu_pool", None)
+
+    async def run():
+        calls = [asyncio.create_task(vision.run_in_cpu_pool(time.sleep, 0.5)) for _ in range(6)]
+        await asyncio.sleep(0.1)
+        for pid in list(vision._cpu_pool._processes):
+            os.kill(pid, signal.SIGKILL)
+        return await asyncio.gather(*calls, return_exceptions=True)
+
+    try:
+        outcomes = asyncio.run(run())
+    finally:
+        vision.shutdown_cpu_pool()
+
+    assert outcomes == [None] * 6
+    assert len(created) == 2
+
+
+class FakeStream:
+    def __init__(self, text):
+        self.text = text
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    async def __aiter__(self):
+        yield SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=self.text))])
+
+
+class FakeClient:
+    def __init__(self, outputs):
+        self.outputs = list(outputs)
+        self.sent = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, **kwargs):
+        self.sent.append(list(messages))
+        return FakeStream(self.outputs.pop(0))
+
+
+def test_retries_send_one_short_repair_turn(monkeypatch):
+    client = FakeClient(["a" * 3000, "b" * 1500, "not json either"])
+
+    async def fake_encode(fn, *args):
+        return "aW1hZ2U="
+
+    monkeypatch.setattr(vision, "get_openai_client", lambda: client)
+    monkeypatch.setattr(vision, "run_in_cpu_pool", fake_encode)
+
+    with pytest.raises(ValidationError):
+        asyncio.run(vision.extract_document_data(Path("scan.jpg")))
+
+    first, second, third = client.sent
+    assert len(first) == 2
+    for sent, previous in ((second, "a" * 3000), (third, "b" * 1500)):
+        assert len(sent) == 4
+        assert sent[:2] == first
+        assert sent[2] == {"role": "assistant", "content": previous[: vision.REPAIR_CONTEXT_CHARS]}
+        assert sent[3]["role"] == "user"
+        assert sent[3]["content"].startswith("Please fix error")
+        assert len(sent[3]["content"]) <= len("Please fix error and capture all data: ") + vision.REPAIR_CONTEXT_CHARS
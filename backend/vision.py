@@ -1,65 +1,199 @@
+import asyncio
+import concurrent.futures
+import hashlib
+import httpx
+import multiprocessing
 import openai
-import json
-import base64
+import orjson
 import os
+import pybase64
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
+from io import BytesIO
 from pathlib import Path
-from .models import FieldDocument
+from typing import Awaitable, Callable, Optional
+from PIL import Image, ImageOps
+from .models import FIELD_DOC_ADAPTER, FieldDocument
 from pydantic import ValidationError
 
 _client = None
+_cpu_pool = None
 
-def get_openai_client() -> openai.OpenAI:
+SCHEMA_PATH = Path(__file__).parent / "schema/field_doc_schema.json"
+
+
+@lru_cache(maxsize=None)
+def load_schema(path: Path = SCHEMA_PATH) -> dict:
+    """Load a strict JSON schema once per path; callers must not mutate it."""
+    schema = orjson.loads(path.read_bytes())
+    schema["additionalProperties"] = False
+    return schema
+
+
+_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "field_document_extraction", "strict": True, "schema": load_schema()},
+}
+
+_SYSTEM_MESSAGE = {
+    "role": "system",
+    "content": (
+        "You are a maritime cargo document parser. Extract ALL values exactly per schema:\n"
+        "1. Tank IDs, dates in ISO-8601, all tank rows,\n"
+        "2. calculate summary totals,\n"
+        "3. preserve decimals, etc."
+    ),
+}
+_USER_TEXT = {"type": "text", "text": "Extract all data from this document, incl. vessel name, tanks, timestamps."}
+
+MAX_IMAGE_SIDE = 2048
+JPEG_QUALITY = 85
+REPAIR_CONTEXT_CHARS = 1000
+MODEL = "o4-mini"
+
+# changes whenever the model, prompt, schema or image preprocessing does; prefixes cache keys
+EXTRACTION_VERSION = hashlib.sha256(
+    orjson.dumps(
+        [
+            MODEL,
+            _SYSTEM_MESSAGE,
+            _USER_TEXT,
+            _RESPONSE_FORMAT,
+            FieldDocument.model_json_schema(),
+            MAX_IMAGE_SIDE,
+            JPEG_QUALITY,
+        ]
+    )
+).hexdigest()[:16]
+
+
+def get_openai_client() -> openai.AsyncOpenAI:
     """Return an OpenAI client or raise a clear error if the API key is missing."""
     global _client
     if _client is None:
         api_key = os.getenv("OPENAI_API_KEY")
         if not api_key:
             raise RuntimeError("OPENAI_API_KEY environment variable is not set")
-        _client = openai.OpenAI(api_key=api_key)
+        http_client = openai.DefaultAsyncHttpxClient(
+            http2=True,
+            limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+        )
+        _client = openai.AsyncOpenAI(api_key=api_key, http_client=http_client)
     return _client
 
 
-def extract_document_data(image_path: Path, max_retries: int = 3) -> FieldDocument:
-    schema = json.loads((Path(__file__).parent / "schema/field_doc_schema.json").read_text())
-    schema["additionalProperties"] = False
+def _web_concurrency() -> int:
+    try:
+        return max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+    except ValueError:
+        return 1
 
-    image_b64 = base64.b64encode(image_path.read_bytes()).decode()
-    system_prompt = (
-        "You are a maritime cargo document parser. Extract ALL values exactly per schema:\n"
-        "1. Tank IDs, dates in ISO-8601, all tank rows,\n"
-        "2. calculate summary totals,\n"
-        "3. preserve decimals, etc."
-    )
+
+def get_cpu_pool() -> concurrent.futures.ProcessPoolExecutor:
+    """Return the process pool used for CPU-bound image work, creating it on first use."""
+    global _cpu_pool
+    if _cpu_pool is None:
+        # split cores between uvicorn workers instead of giving each one a full pool
+        workers = max(1, (os.cpu_count() or 1) // _web_concurrency())
+        _cpu_pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=multiprocessing.get_context("spawn")
+        )
+    return _cpu_pool
+
+
+def shutdown_cpu_pool(wait: bool = True) -> None:
+    """Shut down the CPU pool if it exists; the next get_cpu_pool call recreates it."""
+    global _cpu_pool
+    if _cpu_pool is not None:
+        _cpu_pool.shutdown(wait=wait, cancel_futures=True)
+        _cpu_pool = None
+
+
+async def run_in_cpu_pool(fn, *args):
+    """Run ``fn`` in the CPU pool, rebuilding the pool once if a child has died."""
+    global _cpu_pool
+    loop = asyncio.get_running_loop()
+    pool = get_cpu_pool()
+    try:
+        return await loop.run_in_executor(pool, fn, *args)
+    except BrokenProcessPool:
+        # every in-flight call sees the break; only the first replaces the pool
+        if _cpu_pool is pool:
+            _cpu_pool = None
+            pool.shutdown(wait=False)
+        return await loop.run_in_executor(get_cpu_pool(), fn, *args)
+
+
+def prepare_image(image_path: Path) -> bytes:
+    """Downscale an image to MAX_IMAGE_SIDE and re-encode it as grayscale JPEG."""
+    with Image.open(image_path) as img:
+        # let JPEGs decode at a reduced scale (and straight to grayscale) first
+        img.draft("L", (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        img = ImageOps.exif_transpose(img).convert("L")
+        img.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+        buf = BytesIO()
+        img.save(buf, format="JPEG", quality=JPEG_QUALITY, optimize=True)
+    return buf.getvalue()
+
+
+def encode_image(image_path: Path) -> str:
+    """Prepare an image and return it base64-encoded; runs in the CPU pool."""
+    return pybase64.b64encode_as_string(prepare_image(image_path))
+
+
+async def extract_document_data(
+    image_path: Path,
+    max_retries: int = 3,
+    on_delta: Optional[Callable[[int, str], Awaitable[None]]] = None,
+) -> FieldDocument:
+    """Extract a FieldDocument from an image, streaming the completion.
+
+    If given, ``on_delta`` is awaited with ``(attempt, text)`` for each chunk of
+    model output so callers can forward partial JSON as it arrives.
+    """
+    image_b64 = await run_in_cpu_pool(encode_image, image_path)
     messages = [
-        {"role": "system", "content": system_prompt},
+        _SYSTEM_MESSAGE,
         {
             "role": "user",
             "content": [
-                {"type": "text", "text": "Extract all data from this document, incl. vessel name, tanks, timestamps."},
+                _USER_TEXT,
                 {"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{image_b64}"}},
             ],
         },
     ]
 
-    extracted = None
+    base_messages = messages
     client = get_openai_client()
 
     for attempt in range(max_retries):
+        extracted = None
         try:
-            response = client.chat.completions.create(
-                model="o4-mini",
+            stream = await client.chat.completions.create(
+                model=MODEL,
                 messages=messages,
                 temperature=0,
-                response_format={
-                    "type": "json_schema",
-                    "json_schema": {"name": "field_document_extraction", "strict": True, "schema": schema},
-                },
+                response_format=_RESPONSE_FORMAT,
+                stream=True,
             )
-            extracted = response.choices[0].message.content
-            return FieldDocument.model_validate_json(extracted)
+            parts = []
+            # close the HTTP stream even if on_delta raises or we are cancelled
+            async with stream:
+                async for chunk in stream:
+                    if not chunk.choices or not chunk.choices[0].delta.content:
+                        continue
+                    text = chunk.choices[0].delta.content
+                    parts.append(text)
+                    if on_delta is not None:
+                        await on_delta(attempt, text)
+            extracted = "".join(parts)
+            return FIELD_DOC_ADAPTER.validate_json(extracted)
         except Exception as e:
             if attempt < max_retries - 1:
-                messages.append({"role": "assistant", "content": extracted if extracted else ""})
-                messages.append({"role": "user", "content": f"Please fix error and capture all data: {e}"})
+                # replace, don't accumulate, the previous attempt's context
+                messages = base_messages + [
+                    {"role": "assistant", "content": (extracted or "")[:REPAIR_CONTEXT_CHARS]},
+                    {"role": "user", "content": f"Please fix error and capture all data: {str(e)[:REPAIR_CONTEXT_CHARS]}"},
+                ]
             else:
                 raise